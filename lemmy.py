@@ -1,110 +1,416 @@
+import json
+import os
+import random
 import sys
-from time import sleep
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep, time
 from typing import Optional
 from urllib.parse import urlparse
 
 import requests
 import logging
+from requests.adapters import HTTPAdapter
 
-logger = logging.getLogger(__name__)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data: bytes):
+    """decode json, with orjson when available"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data) -> bytes:
+    """encode json indented by two spaces, with orjson when available"""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode()
+
+
+def new_session() -> requests.Session:
+    """create a session with a connection pool that can be shared between
+    Lemmy instances
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=64))
+    return session
+
+
+class RateLimiter:
+    """Sliding window limiter of requests per minute which also backs off
+    when the server reports that its quota is running low.
+    """
+
+    _window = 60.0  # seconds
+    _low_water = 2  # remaining requests before pausing
+    _epoch_threshold = 1e9  # reset values above this are epoch timestamps
+
+    def __init__(self, rpm: int = 60) -> None:
+        if rpm < 1:
+            raise ValueError(f"rpm must be at least 1, got {rpm}")
+        self._max_rpm = rpm
+        self.rpm = rpm
+        self._sent = deque()
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait_if_throttled(self) -> None:
+        """block until another request may be sent"""
+        while True:
+            # work out the wait under the lock, but sleep without it so other
+            # workers can still report responses and 429s meanwhile
+            with self._lock:
+                now = monotonic()
+                wait = self._resume_at - now
+                if wait <= 0:
+                    # drop requests that fell out of the window
+                    while self._sent and now - self._sent[0] >= self._window:
+                        self._sent.popleft()
+
+                    if len(self._sent) < self.rpm:
+                        self._sent.append(now)
+                        return
+
+                    # the window is full, possibly after the rate was lowered
+                    wait = self._window - (now - self._sent[0])
+
+            sleep(max(0.0, wait))
+
+    def update(self, headers) -> None:
+        """inspect rate limit headers of a successful response"""
+        with self._lock:
+            # additive increase back towards the configured rate
+            self.rpm = min(self._max_rpm, self.rpm + 1)
+
+            try:
+                remaining = int(headers.get("X-RateLimit-Remaining"))
+            except (TypeError, ValueError):
+                return
+            if remaining <= self._low_water:
+                try:
+                    reset = float(headers.get("X-RateLimit-Reset"))
+                except (TypeError, ValueError):
+                    reset = 1.0
+                # timestamp sized values are absolute epoch times, anything
+                # else is seconds from now
+                if reset > self._epoch_threshold:
+                    reset -= time()
+                reset = min(max(reset, 0.0), self._window)
+                self._resume_at = max(self._resume_at, monotonic() + reset)
+
+    def throttled(self, delay: float) -> None:
+        """server rejected a request, pause and halve the request rate"""
+        with self._lock:
+            self.rpm = max(1, self.rpm // 2)
+            self._resume_at = max(self._resume_at, monotonic() + delay)
 
 
 class Lemmy:
     _api_version = "v3"
     _api_base_url = f"api/{_api_version}"
+    _max_workers = 8  # concurrent requests per instance
+    _page_limit = 50  # max communities per page
+    _max_retries = 5  # retries on rate limiting and transient errors
+    _backoff_base = 1.0  # seconds
+    _backoff_cap = 30.0  # seconds
+    _backoff_jitter = 1.0  # seconds
+    _retry_statuses = (500, 502, 503, 504)
+    _timeout = (10, 60)  # connect, read seconds
 
-    def __init__(self, url) -> None:
+    # log line indentation
+    _IND1 = " "
+    _IND2 = "  "
+    _IND3 = "   "
+
+    def __init__(self, url, rpm: int = 60, session: Optional[requests.Session] = None) -> None:
         parsed_url = urlparse(url)
         url_path = parsed_url.netloc if parsed_url.netloc else parsed_url.path
         self.site_url = (
             urlparse(url_path)._replace(scheme="https", netloc=url_path, path="").geturl()
         )
+
+        base = f"{self.site_url}/{self._api_base_url}"
+        self._url_login = f"{base}/user/login"
+        self._url_list = f"{base}/community/list"
+        self._url_resolve = f"{base}/resolve_object"
+        self._url_follow = f"{base}/community/follow"
+        self._url_comments = f"{base}/comment/list"
+
+        self._log = logging.getLogger(f"{__name__}.{url_path}")
         self._auth_token = None
         self._user_communities = set()
+        self._communities_fetched = False
+        self._limiter = RateLimiter(rpm)
+
+        # community actor_id -> community id on this instance, kept between runs
+        self._resolve_cache_file = os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "lemmy_migrate",
+            f"resolve-{url_path}.json",
+        )
+        self._resolve_cache = self._read_cache()
+
+        # reuse keep-alive connections across calls, and across instances
+        # when a session is shared in
+        self._owns_session = session is None
+        self._session = new_session() if session is None else session
+        self._headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self) -> None:
+        """release pooled connections, unless the session was shared in"""
+        session = getattr(self, "_session", None)
+        if session is not None and self._owns_session:
+            session.close()
 
     def login(self, user: str, password: str):
         """authenticate to instance"""
         payload = {"username_or_email": user, "password": password}
 
         resp = self._request_it(
-            f"{self.site_url}/" f"{self._api_base_url}/user/login",
+            self._url_login,
             method="POST",
             json=payload,
         )
-        self._auth_token = resp.json()["jwt"]
+        self._auth_token = json_loads(resp.content)["jwt"]
+        # newer instances read the token from the header rather than the body
+        self._headers["Authorization"] = f"Bearer {self._auth_token}"
 
 
     def get_communities(self, type: str = "Subscribed") -> set:
         """Get list of currently subscribed communites"""
         
         # Return cached communities if already fetched
-        if self._user_communities:
+        if self._communities_fetched:
             return self._user_communities
         
-        self._user_communities = set()
-        payload = {"type_": type, "auth": self._auth_token, "limit": 50, "page": 1}
+        return self.prefetch_subscribed(type)
 
-        # iterate over each page if needed
-        fetched = 50  # max limit
-        while fetched == 50:
-            try:
-                resp = self._request_it(
-                    f"{self.site_url}/" f"{self._api_base_url}/community/list",
-                    params=payload,
-                )
-                fetched = len(resp.json()["communities"])
-                payload["page"] += 1
+    def prefetch_subscribed(self, type: str = "Subscribed") -> set:
+        """Fetch the list of subscribed communities from the instance. The
+        list is then kept up to date locally as communities are subscribed to.
+        Raises if any page cannot be fetched, rather than returning a partial
+        list.
+        """
+        pages = [self._fetch_page(type, 1)]
 
-                for comm in resp.json()["communities"]:
-                    url = comm["community"]["actor_id"]
-                    self._user_communities.add(url)
-            except Exception as err:
-                logger.warning(f"Unable to parse communities for {self.site_url}: {err}")
+        # fetch the remaining pages in concurrent bursts until a short page
+        page = 2
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while len(pages[-1]) == self._page_limit:
+                burst = range(page, page + self._max_workers)
+                for fetched in executor.map(lambda p: self._fetch_page(type, p), burst):
+                    pages.append(fetched)
+                    if len(fetched) < self._page_limit:
+                        break
+                page += self._max_workers
+
+        self._user_communities = {
+            comm["community"]["actor_id"] for fetched in pages for comm in fetched
+        }
+        self._communities_fetched = True
 
         return self._user_communities
 
-    def subscribe(self, communities: list) -> None:
-        """Subscribe to a community. It will first attempt to
-        resolve community.
+    def _fetch_page(self, type: str, page: int) -> list:
+        """fetch a single page of communities"""
+        payload = {
+            "type_": type,
+            "auth": self._auth_token,
+            "limit": self._page_limit,
+            "page": page,
+        }
+        resp = self._request_it(
+            self._url_list,
+            params=payload,
+        )
+        return json_loads(resp.content)["communities"]
+
+    def subscribe(self, communities: list, known: Optional[set] = None) -> None:
+        """Subscribe to a list of communities. Communities in `known` or
+        already subscribed to are skipped. Communities not already in the
+        resolve cache are first resolved concurrently, then the ones not
+        already followed are subscribed to concurrently.
         """
-        payload = {"community_id": None, "follow": True, "auth": self._auth_token}
+        known = (known or set()) | self._user_communities
 
+        cached = {}
+        to_resolve = []
         for url in communities:
-            try:
-                # resolve community first
-                comm_id = self.resolve_community(url)
+            if url in known:
+                continue
+            if url in self._resolve_cache:
+                cached[url] = self._resolve_cache[url]
+            else:
+                to_resolve.append(url)
 
-                if comm_id:
-                    payload["community_id"] = comm_id
-                    self._println(2, f"> Subscribing to {url} ({comm_id})")
-                    resp = self._request_it(
-                        f"{self.site_url}/" f"{self._api_base_url}/" f"community/follow",
-                        json=payload,
-                        method="POST",
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            fresh = {}  # community id -> url
+            self._collect_resolved(executor, to_resolve, fresh)
+
+            # a fresh resolve takes priority over a cached id, and a cached id
+            # may only be followed once, so cached urls losing either way are
+            # stale and resolved again
+            cached_ids = {}  # community id -> url
+            stale = []
+            for url, comm_id in cached.items():
+                if comm_id in fresh or comm_id in cached_ids:
+                    self._log.info(
+                        "%s> Cached id %s for %s is stale, resolving again",
+                        self._IND2,
+                        comm_id,
+                        url,
                     )
+                    self._resolve_cache.pop(url, None)
+                    stale.append(url)
+                else:
+                    cached_ids[comm_id] = url
+            self._collect_resolved(executor, stale, fresh)
+
+            follows = [(url, comm_id, False) for comm_id, url in fresh.items()]
+            follows += [(url, comm_id, True) for comm_id, url in cached_ids.items()]
+
+            # consume the iterator so every task runs before the pool closes
+            list(executor.map(lambda f: self._follow(*f, known=known), follows))
+
+        self._write_cache()
+
+    def _collect_resolved(self, executor, urls: list, resolved: dict) -> None:
+        """resolve urls concurrently into `resolved` (community id -> url),
+        skipping communities that are already followed
+        """
+        for url, view in zip(urls, executor.map(self._resolve_view, urls)):
+            if not view:
+                continue
+            comm_id = view["community"]["id"]
+            if view.get("subscribed") == "Subscribed":
+                self._user_communities.add(url)
+                self._log.info("%s> Already subscribed to %s (%s)", self._IND2, url, comm_id)
+                continue
+            if resolved.setdefault(comm_id, url) != url:
+                self._log.info(
+                    "%s> %s is the same community as %s (%s)",
+                    self._IND2,
+                    url,
+                    resolved[comm_id],
+                    comm_id,
+                )
+
+    def _follow(
+        self, url: str, comm_id: int, cached: bool = False, known: Optional[set] = None
+    ) -> None:
+        """subscribe to a single resolved community. If the id came from the
+        resolve cache and the follow fails or lands on a different community,
+        the cache entry is dropped and the community is resolved once more.
+        """
+        payload = {"community_id": comm_id, "follow": True, "auth": self._auth_token}
+        self._log.info("%s> Subscribing to %s (%s)", self._IND2, url, comm_id)
+        try:
+            resp = self._request_it(
+                self._url_follow,
+                json=payload,
+                method="POST",
+            )
+
+            if cached:
+                followed = json_loads(resp.content)["community_view"]["community"]["actor_id"]
+                if followed != url:
+                    # the cached id now belongs to another community, undo the
+                    # follow unless that community was already subscribed to
+                    already = (known or set()) | self._user_communities
+                    if followed not in already:
+                        self._request_it(
+                            self._url_follow,
+                            json={**payload, "follow": False},
+                            method="POST",
+                        )
+                    raise ValueError(f"community {comm_id} is now {followed}")
 
-                    if resp.status_code == 200:
-                        self._user_communities.add(comm_id)
-                        self._println(3, f"> Succesfully subscribed" f" to {url} ({comm_id})")
-            except Exception as e:
-                logger.warning(f"API error while subscribing to {url}: {e}")
+            if resp.status_code == 200:
+                self._user_communities.add(url)
+                self._log.info("%s> Succesfully subscribed to %s (%s)", self._IND3, url, comm_id)
+        except Exception as e:
+            if cached:
+                self._log.info(
+                    "%s> Cached id %s for %s is stale, resolving again: %s",
+                    self._IND3,
+                    comm_id,
+                    url,
+                    e,
+                )
+                self._resolve_cache.pop(url, None)
+                comm_id = self.resolve_community(url)
+                if comm_id:
+                    self._follow(url, comm_id)
+                return
+            self._log.warning("API error while subscribing to %s: %s", url, e)
 
     def resolve_community(self, community: str) -> int | None:
         """resolve a community"""
+        if community in self._resolve_cache:
+            return self._resolve_cache[community]
+
+        view = self._resolve_view(community)
+        return view["community"]["id"] if view else None
+
+    def _resolve_view(self, community: str) -> dict | None:
+        """resolve a community, returning its community view"""
         payload = {"q": community, "auth": self._auth_token}
 
-        community_id = None
-        self._println(1, f"> Resolving {community}")
+        view = None
+        self._log.info("%s> Resolving %s", self._IND1, community)
         try:
             resp = self._request_it(
-                f"{self.site_url}/" f"{self._api_base_url}/resolve_object",
+                self._url_resolve,
                 params=payload,
             )
-            community_id = resp.json()["community"]["community"]["id"]
+            view = json_loads(resp.content)["community"]
+            self._resolve_cache[community] = view["community"]["id"]
+        except Exception as e:
+            self._log.info("%s> Failed to resolve community %s", self._IND2, e)
+            view = None
+
+        return view
+
+    def _read_cache(self) -> dict:
+        try:
+            with open(self._resolve_cache_file, "rb") as f:
+                cache = json_loads(f.read())
+        except FileNotFoundError:
+            return {}
         except Exception as e:
-            self._println(2, f"> Failed to resolve community {e}")
+            self._log.debug("Ignoring unreadable resolve cache %s: %s", self._resolve_cache_file, e)
+            return {}
 
-        return community_id
+        if not isinstance(cache, dict):
+            self._log.debug("Ignoring malformed resolve cache %s", self._resolve_cache_file)
+            return {}
+        return cache
+
+    def _write_cache(self) -> None:
+        """atomically replace the resolve cache on disk"""
+        tmp = f"{self._resolve_cache_file}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self._resolve_cache_file), exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(json_dumps(self._resolve_cache))
+            os.replace(tmp, self._resolve_cache_file)
+        except Exception as e:
+            self._log.debug("Unable to write resolve cache %s: %s", self._resolve_cache_file, e)
 
     def get_comments(self, post_id: str, max_depth: int = 1, limit: int = 1000) -> Optional[dict]:
         """Get all comments for a post"""
@@ -115,16 +421,11 @@ class Lemmy:
         }
 
         try:
-            r = self._request_it(
-                f"{self.site_url}/{self._api_base_url}/" f"comment/list", params=payload
-            )
+            r = self._request_it(self._url_comments, params=payload)
         except Exception as e:
-            self._println(2, f"> Failed to get comment list")
+            self._log.info("%s> Failed to get comment list", self._IND2)
         else:
-            return r.json()["comments"]
-
-    def _rate_limit(self):
-        sleep(1)
+            return json_loads(r.content)["comments"]
 
     def _request_it(
         self,
@@ -133,15 +434,55 @@ class Lemmy:
         params: Optional[str | dict] = None,
         json: Optional[dict] = None,
     ) -> requests.Response:
-        self._rate_limit()
-        try:
-            r = requests.request(method, url=endpoint, params=params, json=json)
+        for attempt in range(self._max_retries + 1):
+            retry = attempt < self._max_retries
+            self._limiter.wait_if_throttled()
+            try:
+                r = self._session.request(
+                    method,
+                    url=endpoint,
+                    params=params,
+                    json=json,
+                    headers=self._headers,
+                    timeout=self._timeout,
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not retry:
+                    raise
+                delay = self._backoff(attempt)
+                self._log.debug(
+                    "Connection error to %s, retrying in %.1fs: %s", self.site_url, delay, e
+                )
+                sleep(delay)
+                continue
+
+            if r.status_code == 429 and retry:
+                delay = self._retry_after(r) or self._backoff(attempt)
+                self._log.debug("Rate limited by %s, retrying in %.1fs", self.site_url, delay)
+                self._limiter.throttled(delay)
+                continue
+
+            if r.status_code in self._retry_statuses and retry:
+                delay = self._retry_after(r) or self._backoff(attempt)
+                self._log.debug(
+                    "HTTP %s from %s, retrying in %.1fs", r.status_code, self.site_url, delay
+                )
+                sleep(delay)
+                continue
+
             r.raise_for_status()
+            self._limiter.update(r.headers)
             return r
-        except requests.exceptions.HTTPError as e:
-            raise
-        except requests.exceptions.RequestException as e:
-            raise
 
-    def _println(self, indent, line):
-        logger.info(f"{' ' * indent}{line}")
+    def _backoff(self, attempt: int) -> float:
+        """exponential backoff with jitter"""
+        delay = min(self._backoff_cap, self._backoff_base * 2**attempt)
+        return delay + random.uniform(0, self._backoff_jitter)
+
+    def _retry_after(self, resp: requests.Response) -> float | None:
+        """Retry-After in seconds, capped at the maximum backoff"""
+        try:
+            delay = float(resp.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return None
+        return min(max(delay, 0.0), self._backoff_cap)
@@ -1,25 +1,23 @@
 import argparse
 import configparser
-import json
 import logging
 import os
 import sys
 from logging import handlers
 
-from lemmy import Lemmy
+from lemmy import Lemmy, json_dumps, json_loads, new_session
 
 logger = logging.getLogger(__name__)
 
 
-def get_config(cfile):
+def get_config(cfile) -> configparser.ConfigParser:
     config = configparser.ConfigParser(interpolation=None)
     read = config.read(cfile)
     if not read:
         logger.warning(f"Could not read config {cfile}!")
         sys.exit(1)
 
-    accounts = {i: dict(config.items(i)) for i in config.sections()}
-    return accounts
+    return config
 
 
 def get_args():
@@ -48,31 +46,37 @@ def sync_subscriptions(src_acct: Lemmy, dest_acct: Lemmy, from_backup):
         f"[ Subscribing {dest_acct.site_url} to new communities from " f"{src_acct.site_url} ]"
     )
     logger.info(" Getting list of subscribed communities from the two communities")
-    if from_backup:
-        src_comms = from_backup
-    else:
-        src_comms = src_acct.get_communities()
+    try:
+        src_comms = from_backup if from_backup else src_acct.get_communities()
+        dest_comms = dest_acct.get_communities()
+    except Exception as e:
+        logger.warning(f" Unable to get subscribed communities, skipping: {e}")
+        return
+
     logger.info(
         f" {len(src_comms)} subscribed communities found in the source" f" {src_acct.site_url}"
     )
-
-    dest_comms = dest_acct.get_communities()
     logger.info(
         f" {len(dest_comms)} subscribed communities found in the target" f" {dest_acct.site_url}"
     )
 
-    new_communities = [c for c in src_comms if c not in dest_comms]
+    new_communities = list(src_comms - dest_comms)
 
     if new_communities:
         logger.info(f" Subscribing to {len(new_communities)} new communities")
-        dest_acct.subscribe(new_communities)
+        dest_acct.subscribe(new_communities, known=dest_comms)
 
 
 def write_backup(account: Lemmy, output: str) -> None:
-    comms = account.get_communities()
     try:
-        with open(output, "w") as f:
-            json.dump({account.site_url: list(comms)}, f, indent=4)
+        comms = account.get_communities()
+    except Exception as e:
+        logger.error(f"  Unable to get subscribed communities, {output} not written: {e}")
+        return
+
+    try:
+        with open(output, "wb") as f:
+            f.write(json_dumps({account.site_url: list(comms)}))
     except Exception as e:
         logger.exception(f"  Error exporting file {output}.", exc_info=e)
     else:
@@ -82,8 +86,8 @@ def write_backup(account: Lemmy, output: str) -> None:
 def read_backup(file: str) -> set | None:
     comms = None
     try:
-        with open(file, "r") as f:
-            data = json.load(f)
+        with open(file, "rb") as f:
+            data = json_loads(f.read())
             comms = {c for k, v in data.items() for c in v}
     except Exception as e:
         logger.exception(f"Failed to read import list {file}.", exc_info=e)
@@ -94,12 +98,28 @@ def read_backup(file: str) -> set | None:
 
 
 def main():
+    session = new_session()
+    try:
+        run(session)
+    finally:
+        session.close()
+
+
+def run(session):
     cfg = get_args()
     accounts = get_config(cfg.c)
 
     # source site
     logger.info(f"[ Getting Main Account info -" f" {accounts['Main Account']['site']} ]")
-    main_lemming = Lemmy(accounts["Main Account"]["site"])
+    try:
+        main_lemming = Lemmy(
+            accounts["Main Account"]["site"],
+            rpm=accounts["Main Account"].getint("rpm", fallback=60),
+            session=session,
+        )
+    except ValueError as e:
+        logger.error(f"Invalid settings for main account: {e}")
+        sys.exit(1)
     try:
         main_lemming.login(accounts["Main Account"]["user"], accounts["Main Account"]["password"])
     except Exception as e:
@@ -108,8 +128,6 @@ def main():
     else:
         logger.info("Main account login successful.")
 
-    accounts.pop("Main Account", None)
-
     # export subscriptions
     if cfg.e:
         write_backup(main_lemming, cfg.e)
@@ -121,11 +139,20 @@ def main():
         comms_backup = read_backup(cfg.i)
 
     # sync main account communities to each account
-    for acc in accounts:
-        logger.info(f"[ Getting {acc} - {accounts[acc]['site']} ]")
-        new_lemming = Lemmy(accounts[acc]["site"])
+    for acc in (s for s in accounts.sections() if s != "Main Account"):
+        account = accounts[acc]
+        logger.info(f"[ Getting {acc} - {account['site']} ]")
+        try:
+            new_lemming = Lemmy(
+                account["site"], rpm=account.getint("rpm", fallback=60), session=session
+            )
+        except ValueError as e:
+            logger.warning(f"Invalid settings for {acc}: {e}")
+            logger.info("Continuing to next account.")
+            continue
+
         try:
-           new_lemming.login(accounts[acc]["user"], accounts[acc]["password"])
+           new_lemming.login(account["user"], account["password"])
         except Exception as e:
             logger.debug(f"Unable to login to {acc}.", exc_info=e)
             logger.warning(f"Unable to login to {acc}. Check your credentials and try again.")